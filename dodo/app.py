@@ -23,7 +23,7 @@ from PyQt5.QtWebEngineCore import QWebEngineUrlScheme
 import sys
 import os
 import subprocess
-from typing import Optional
+from typing import Optional, List, Tuple
 
 from . import search
 from . import thread
@@ -53,6 +53,21 @@ class SyncMailThread(QThread):
         subprocess.run(['notmuch', 'new'], stdout=subprocess.PIPE)
 
 
+class NotmuchNewThread(QThread):
+    """A QThread used for indexing new mail and applying pending tag changes
+
+    Called by the :func:`~dodo.app.Dodo.notmuch_new` method."""
+
+    def __init__(self, tag_ops: List[Tuple[str, str]], parent: QObject=None) -> None:
+        super().__init__(parent)
+        self.tag_ops = tag_ops
+
+    def run(self) -> None:
+        """Run `notmuch new` then apply the tag operations with :func:`~dodo.util.notmuch_tag_batch`"""
+        subprocess.run(['notmuch', 'new'], stdout=subprocess.PIPE)
+        util.notmuch_tag_batch(self.tag_ops)
+
+
 class Dodo(QApplication):
     """The main Dodo application
 
@@ -98,6 +113,14 @@ class Dodo(QApplication):
             timer.timeout.connect(self.sync_mail)
             timer.start(settings.sync_mail_interval * 1000)
 
+        # requests to run "notmuch new" are collected for a short time, then handled together
+        self.pending_tag_ops: List[Tuple[str, str]] = []
+        self.notmuch_new_thread: Optional[NotmuchNewThread] = None
+        self.notmuch_new_timer = QTimer(self)
+        self.notmuch_new_timer.setSingleShot(True)
+        self.notmuch_new_timer.setInterval(500)
+        self.notmuch_new_timer.timeout.connect(self.run_notmuch_new)
+
         # open inbox and make un-closeable
         self.search('tag:inbox', keep_open=True)
 
@@ -221,6 +244,40 @@ class Dodo(QApplication):
         t.finished.connect(done)
         t.start()
 
+    def notmuch_new(self, tag_ops: Optional[List[Tuple[str, str]]]=None) -> None:
+        """Index new mail with 'notmuch new', then apply the given tag operations
+
+        This is called after a message is sent. Since 'notmuch new' scans the whole Maildir, calls
+        made in quick succession are coalesced into a single run.
+
+        :param tag_ops: a list of pairs (tag_expr, query), as in :func:`~dodo.util.notmuch_tag_batch`
+        """
+
+        if tag_ops: self.pending_tag_ops += tag_ops
+        self.notmuch_new_timer.start()
+
+    def run_notmuch_new(self) -> None:
+        """Start a :class:`~dodo.app.NotmuchNewThread` for all pending requests"""
+
+        # wait for the previous run to finish
+        if self.notmuch_new_thread:
+            self.notmuch_new_timer.start()
+            return
+
+        t = NotmuchNewThread(self.pending_tag_ops, parent=self)
+        self.pending_tag_ops = []
+        self.notmuch_new_thread = t
+
+        def done() -> None:
+            self.notmuch_new_thread = None
+            self.invalidate_panels()
+            w = self.tabs.currentWidget()
+            if w: w.refresh()
+            t.deleteLater()
+
+        t.finished.connect(done)
+        t.start()
+
     def num_panels(self) -> int:
         """Returns the number of panels (i.e. tabs) currently open"""
 
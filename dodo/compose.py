@@ -17,21 +17,31 @@
 # along with Dodo. If not, see <https://www.gnu.org/licenses/>.
 
 from __future__ import annotations
-from typing import Optional, List, Set
+from typing import Optional, List, Set, Tuple, Dict, BinaryIO
 
 from PyQt5.QtCore import *
 from PyQt5.QtWidgets import *
 from PyQt5.QtWebEngineWidgets import *
-import mailbox
+import base64
 import email
 import email.utils
 import email.parser
+import email.generator
+import io
+import itertools
+import json
 import mimetypes
 import subprocess
-from subprocess import PIPE, Popen, TimeoutExpired
+from subprocess import Popen, TimeoutExpired
+from concurrent.futures import ThreadPoolExecutor
 import tempfile
 import os
+import queue
 import re
+import socket
+import threading
+import time
+import uuid
 
 from . import app
 from . import panel
@@ -39,6 +49,143 @@ from . import keymap
 from . import settings
 from . import util
 
+email_sep = re.compile(r'\s*[;,]\s*')
+
+maildir_counter = itertools.count(1)
+
+def maildir_unique() -> str:
+    """Return a unique file name for delivering a message into a Maildir
+
+    This follows the Maildir naming convention "TIME.MusecPpidQcount.HOST", so no directory
+    listing is needed to avoid collisions."""
+
+    t = time.time()
+    host = socket.gethostname().replace('/', '\\057').replace(':', '\\072')
+    return f'{int(t)}.M{int((t % 1) * 1000000)}P{os.getpid()}Q{next(maildir_counter)}.{host}'
+
+def add_attachment_stub(eml: email.message.EmailMessage, path: str) -> str:
+    """Add an attachment part to a message, without reading the file
+
+    The payload of the new part is a unique marker, which :func:`write_message` replaces
+    with the base64-encoded contents of the file as the message is written out. This way,
+    an attachment never needs to be held in memory in full.
+
+    :param eml: the message
+    :param path: the file to attach
+    :returns: the marker used as a placeholder for the file contents
+    """
+
+    mime, _ = mimetypes.guess_type(path)
+    if mime and len(mime.split('/')) == 2:
+        ty = mime.split('/')
+    else:
+        ty = ['application', 'octet-stream']
+
+    eml.add_attachment(b'', maintype=ty[0], subtype=ty[1], filename=os.path.basename(path), cte='base64')
+    marker = 'dodo-attachment-' + uuid.uuid4().hex
+    part = list(eml.iter_attachments())[-1]
+    part.set_payload(marker)
+    return marker
+
+def encode_attachment(path: str, q: queue.Queue[Optional[bytes]], stop: threading.Event) -> None:
+    """Read a file and put its base64 encoding on a queue, one chunk at a time
+
+    This is used by :func:`write_message` to read several attachments in parallel. Once the
+    file is done (or reading it failed), None is put on the queue.
+
+    :param path: the file to encode
+    :param q: the queue receiving the encoded chunks
+    :param stop: if this gets set, stop reading early
+    """
+
+    try:
+        with open(path, 'rb') as att:
+            # encode a multiple of 57 bytes at a time, so the 76-character lines line up
+            while not stop.is_set():
+                chunk = att.read(57 * 1024)
+                if not chunk: break
+                q.put(base64.encodebytes(chunk))
+    finally:
+        q.put(None)
+
+def write_message(eml: email.message.EmailMessage, attachments: Dict[str, str], f: BinaryIO) -> None:
+    """Write a message to a binary file, streaming attachments from disk
+
+    Attachments are read and encoded in parallel by :func:`encode_attachment`, but only a
+    limited number of chunks per file are buffered ahead of the output.
+
+    :param eml: the message
+    :param attachments: a dictionary from markers returned by :func:`add_attachment_stub`
+                        to the corresponding file paths
+    :param f: the output file
+    """
+
+    buf = io.BytesIO()
+    email.generator.BytesGenerator(buf).flatten(eml)
+    data = buf.getvalue()
+
+    stop = threading.Event()
+    queues: List[queue.Queue[Optional[bytes]]] = [queue.Queue(maxsize=16) for _ in attachments]
+    finished = 0
+
+    with ThreadPoolExecutor(max_workers=4) as ex:
+        futures = [ex.submit(encode_attachment, path, q, stop)
+                   for path, q in zip(attachments.values(), queues)]
+        try:
+            # markers appear in the same order as the attachments were added
+            pos = 0
+            for marker, q, fut in zip(attachments, queues, futures):
+                i = data.index(marker.encode('ascii'), pos)
+                f.write(data[pos:i])
+                while True:
+                    chunk = q.get()
+                    if chunk is None: break
+                    f.write(chunk)
+                finished += 1
+                fut.result()
+                pos = i + len(marker)
+            f.write(data[pos:])
+        finally:
+            # on error, let any remaining workers run to completion
+            stop.set()
+            for q in queues[finished:]:
+                while q.get() is not None: pass
+
+def write_sent_tmp(eml: email.message.EmailMessage, attachments: Dict[str, str]) -> str:
+    """Write a message into the "tmp" subdirectory of :func:`~dodo.settings.sent_dir`
+
+    This is the only time an outgoing message gets serialized. The resulting file is fed
+    to :func:`~dodo.settings.send_mail_command` and, if sending succeeds, moved into the
+    sent folder with :func:`move_sent_to_cur`.
+
+    :param eml: the message to be sent
+    :param attachments: attachment files to stream into the message, see :func:`write_message`
+    :returns: the path of the new file
+    """
+
+    sent_dir = os.path.expanduser(settings.sent_dir)
+    if not os.path.exists(sent_dir):
+        for sub in ['tmp', 'new', 'cur']:
+            os.makedirs(os.path.join(sent_dir, sub))
+
+    tmp_file = os.path.join(sent_dir, 'tmp', maildir_unique())
+    fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write_message(eml, attachments, f)
+            f.flush()
+            os.fsync(f.fileno())
+    except Exception:
+        os.remove(tmp_file)
+        raise
+    return tmp_file
+
+def move_sent_to_cur(tmp_file: str) -> None:
+    """Move a file written by :func:`write_sent_tmp` into "cur", with the "seen" flag set"""
+
+    sent_dir = os.path.dirname(os.path.dirname(tmp_file))
+    os.rename(tmp_file, os.path.join(sent_dir, 'cur', os.path.basename(tmp_file) + ':2,S'))
+
 class ComposePanel(panel.Panel):
     """A panel for composing messages
 
@@ -56,6 +203,24 @@ class ComposePanel(panel.Panel):
         self.message_view = QWebEngineView()
         self.message_view.setZoomFactor(1.2)
         self.layout().addWidget(self.message_view)
+
+        # the page is only loaded once, then refresh() updates its contents in place
+        self.page_loaded = False
+        self._refresh_pending = False
+        self._shown_message_string: Optional[str] = None
+        def loaded(ok: bool) -> None:
+            self.page_loaded = True
+            self.refresh()
+        self.message_view.loadFinished.connect(loaded)
+        self.message_view.setHtml(f"""<html>
+        <style type="text/css">
+        {util.make_message_css()}
+        </style>
+        <body>
+        <p id="status"></p>
+        <pre id="message" style="white-space: pre-wrap"></pre>
+        </body></html>""")
+
         self.status = f'<i style="color:{settings.theme["fg"]}">draft</i>'
 
         self.message_string = f'From: {settings.email_address}\n'
@@ -83,7 +248,6 @@ class ComposePanel(panel.Panel):
 
             if mode == 'replyall':
                 cc = []
-                email_sep = re.compile('\s*[;,]\s*')
                 if 'To' in msg['headers']:
                     cc += email_sep.split(msg['headers']['To'])
                 if 'Cc' in msg['headers']:
@@ -128,18 +292,28 @@ class ComposePanel(panel.Panel):
     def refresh(self) -> None:
         """Refresh the message text
 
-        This gets called automatically after the external editor has closed."""
+        This gets called automatically after the external editor has closed. Only the status and
+        message elements of the page are replaced, rather than reloading the whole page. The update
+        happens once control returns to the event loop, so several calls in a row only update the
+        page once."""
 
-        text = util.colorize_text(util.simple_escape(self.message_string), has_headers=True)
+        if self._refresh_pending: return
+        self._refresh_pending = True
+        QTimer.singleShot(0, self._do_refresh)
 
-        self.message_view.setHtml(f"""<html>
-        <style type="text/css">
-        {util.make_message_css()}
-        </style>
-        <body>
-        <p>{self.status}</p>
-        <pre style="white-space: pre-wrap">{text}</pre>
-        </body></html>""")
+    def _do_refresh(self) -> None:
+        self._refresh_pending = False
+
+        if self.page_loaded:
+            js = f'document.getElementById("status").innerHTML = {json.dumps(self.status)};'
+
+            # most refreshes only change the status, so only escape and send the message when it changed
+            if self._shown_message_string is not self.message_string:
+                self._shown_message_string = self.message_string
+                text = util.colorize_text(util.simple_escape(self.message_string), has_headers=True)
+                js += f'document.getElementById("message").innerHTML = {json.dumps(text)};'
+
+            self.message_view.page().runJavaScript(js, QWebEngineScript.ApplicationWorld)
 
         super().refresh()
 
@@ -186,6 +360,8 @@ class ComposePanel(panel.Panel):
 
             def done() -> None:
                 if self.sendmail_thread:
+                    if self.sendmail_thread.sent:
+                        self.app.notmuch_new(self.sendmail_thread.tag_ops)
                     self.sendmail_thread.deleteLater()
                     self.sendmail_thread = None
                 self.refresh()
@@ -204,16 +380,18 @@ class EditorThread(QThread):
         self.panel = panel
 
     def run(self) -> None:
-        fd, file = tempfile.mkstemp('.eml')
-        with os.fdopen(fd, 'w') as f:
+        with tempfile.NamedTemporaryFile('w', suffix='.eml', encoding='utf-8', delete=False) as f:
             f.write(self.panel.message_string)
+            file = f.name
 
-        cmd = settings.editor_command.format(file=file)
-        subprocess.run(cmd, shell=True)
+        try:
+            cmd = settings.editor_command.format(file=file)
+            subprocess.run(cmd, shell=True)
 
-        with open(file, 'r') as f1:
-            self.panel.message_string = f1.read()
-        os.remove(file)
+            with open(file, 'rb') as f1:
+                self.panel.message_string = f1.read().decode('utf-8')
+        finally:
+            os.unlink(file)
 
 class SendmailThread(QThread):
     """A QThread used for editing mail with the external editor
@@ -223,17 +401,19 @@ class SendmailThread(QThread):
     def __init__(self, panel: ComposePanel, parent: Optional[QObject]=None):
         super().__init__(parent)
         self.panel = panel
+        self.sent = False
+        self.tag_ops: List[Tuple[str, str]] = []
 
     def run(self) -> None:
         try:
             m = email.message_from_string(self.panel.message_string)
             eml = email.message.EmailMessage()
             attachments = []
-            for h in m.keys():
-                if h == 'A':
-                    attachments.append(m[h])
+            for name, value in m.items():
+                if name == 'A':
+                    attachments.append(value)
                 else:
-                    eml[h] = m[h]
+                    eml[name] = value
 
             eml['Message-ID'] = email.utils.make_msgid()
             eml['User-Agent'] = 'Dodo'
@@ -263,40 +443,62 @@ class SendmailThread(QThread):
                 eml["References"] = ' '.join(refs)
 
 
+            att_files: Dict[str, str] = {}
             for att in attachments:
-                mime, _ = mimetypes.guess_type(att)
-                if mime and len(mime.split('/')) == 2:
-                    ty = mime.split('/')
-                else:
-                    ty = ['application', 'octet-stream']
-
+                path = os.path.expanduser(att)
                 try:
-                    with open(os.path.expanduser(att), 'rb') as f1:
-                        data = f1.read()
-                        eml.add_attachment(data, maintype=ty[0], subtype=ty[1], filename=os.path.basename(att))
-                except IOError:
+                    size = os.stat(path).st_size
+                except OSError:
                     print("Can't read attachment: " + att)
+                    continue
+
+                if settings.max_attachment_size != -1 and size > settings.max_attachment_size:
+                    self.panel.status = (f'<i style="color:{settings.theme["fg_bad"]}">' +
+                                         f'attachment too large: {util.simple_escape(att)}</i>')
+                    return
 
-            sendmail = Popen(settings.send_mail_command, stdin=PIPE, encoding='utf8', shell=True)
-            if sendmail.stdin:
-                sendmail.stdin.write(str(eml))
-                sendmail.stdin.close()
+                att_files[add_attachment_stub(eml, path)] = path
+
+            # serialize the message once, then use the same file for sendmail and the sent folder
+            tmp_file = write_sent_tmp(eml, att_files)
+        except OSError as e:
+            print("Error writing message: " + str(e))
+            self.panel.status = f'<i style="color:{settings.theme["fg_bad"]}">error</i>'
+            return
+
+        try:
+            # sendmail reads the file directly, so no message bytes pass through Python
+            with open(tmp_file, 'rb') as f:
+                sendmail = Popen(settings.send_mail_command, stdin=f, shell=True)
             sendmail.wait(30)
-            if sendmail.returncode == 0:
-                # save to sent folder
-                m = mailbox.MaildirMessage(str(eml))
-                m.set_flags('S')
-                key = mailbox.Maildir(settings.sent_dir).add(m)
-                # print(f'add: {key}')
-
-                subprocess.run(['notmuch', 'new'])
-
-                if ((self.panel.mode == 'reply' or self.panel.mode == 'replyall') and
-                        self.panel.msg and 'id' in self.panel.msg):
-                    subprocess.run(['notmuch', 'tag', '+replied', '--', 'id:' + self.panel.msg['id']])
-                self.panel.app.invalidate_panels()
-                self.panel.status = f'<i style="color:{settings.theme["fg_good"]}">sent</i>'
-            else:
-                self.panel.status = f'<i style="color:{settings.theme["fg_bad"]}">error</i>'
         except TimeoutExpired:
+            os.remove(tmp_file)
             self.panel.status = f'<i style="color:{settings.theme["fg_bad"]}">timed out</i>'
+            return
+        except OSError as e:
+            print("Error sending message: " + str(e))
+            os.remove(tmp_file)
+            self.panel.status = f'<i style="color:{settings.theme["fg_bad"]}">error</i>'
+            return
+
+        if sendmail.returncode != 0:
+            os.remove(tmp_file)
+            self.panel.status = f'<i style="color:{settings.theme["fg_bad"]}">error</i>'
+            return
+
+        # the message has been delivered at this point, so report it as sent even if the copy
+        # in the sent folder can't be saved
+        self.sent = True
+
+        # indexing is left to the app, which runs "notmuch new" once sending is done
+        if ((self.panel.mode == 'reply' or self.panel.mode == 'replyall') and
+                self.panel.msg and 'id' in self.panel.msg):
+            self.tag_ops.append(('+replied', 'id:' + self.panel.msg['id']))
+
+        try:
+            move_sent_to_cur(tmp_file)
+            self.panel.status = f'<i style="color:{settings.theme["fg_good"]}">sent</i>'
+        except OSError as e:
+            print("Message sent, but couldn't save it to the sent folder: " + str(e))
+            self.panel.status = (f'<i style="color:{settings.theme["fg_good"]}">sent</i> ' +
+                                 f'<i style="color:{settings.theme["fg_bad"]}">(not saved to sent folder)</i>')
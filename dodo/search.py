@@ -17,9 +17,9 @@
 # along with Dodo. If not, see <https://www.gnu.org/licenses/>.
 
 from __future__ import annotations
-from typing import Optional, Any, overload
+from typing import Optional, Any, Callable, List, Tuple, FrozenSet, overload
 
-from PyQt5.QtCore import Qt, QAbstractItemModel, QModelIndex, QObject
+from PyQt5.QtCore import Qt, QAbstractItemModel, QModelIndex, QObject, QThread
 from PyQt5.QtWidgets import QTreeView, QWidget
 from PyQt5.QtGui import QFont, QColor
 import subprocess
@@ -31,7 +31,45 @@ from . import keymap
 from . import thread
 from . import panel
 
-columns = ['date', 'from', 'subject', 'tags']
+columns = ('date', 'from', 'subject', 'tags')
+
+column_keys = {'date': 'date_relative', 'from': 'authors', 'subject': 'subject'}
+"""The JSON field of a "notmuch search" result shown in each (non-tag) column"""
+
+def search_json(q: str) -> List[dict]:
+    """Run "notmuch search" and return the parsed JSON results
+
+    :param q: a notmuch query string
+    :returns: a list of JSON thread summaries"""
+
+    p = subprocess.Popen(['notmuch', 'search', '--format=json', q],
+            stdout=subprocess.PIPE)
+    d = json.load(p.stdout) if p.stdout else []
+    p.wait()
+
+    # "query" holds the ids of every message in the thread, which can be long and isn't used
+    for t in d: t.pop('query', None)
+    return d
+
+def tag_string(tags: List[str]) -> str:
+    """Render a list of tags for the tags column, using the icons in `settings.tag_icons` where
+    possible"""
+
+    return ' '.join(settings.tag_icons.get(x, f'[{x}]') for x in tags)
+
+class SearchRefreshThread(QThread):
+    """A QThread used for running "notmuch search" in the background
+
+    Used by the :func:`~dodo.search.SearchPanel.refresh` method. Once the thread has finished,
+    the results are available in the `result` attribute."""
+
+    def __init__(self, q: str, parent: Optional[QObject]=None):
+        super().__init__(parent)
+        self.q = q
+        self.result: List[dict] = []
+
+    def run(self) -> None:
+        self.result = search_json(self.q)
 
 class SearchModel(QAbstractItemModel):
     """A model containing the results of a search"""
@@ -39,17 +77,76 @@ class SearchModel(QAbstractItemModel):
     def __init__(self, q: str):
         super().__init__()
         self.q = q
+
+        # data() is called for every visible cell on every repaint, so build the fonts and colors
+        # it returns once here
+        self._font_normal = QFont(settings.search_font, settings.search_font_size)
+        self._font_bold = QFont(settings.search_font, settings.search_font_size)
+        self._font_bold.setBold(True)
+
+        # a pair (normal color, unread color) for each column
+        self._fg: List[Tuple[QColor, QColor]] = []
+        for col in columns:
+            fg = settings.theme.get('fg_' + col, settings.theme['fg'])
+            self._fg.append((QColor(fg), QColor(settings.theme.get('fg_' + col + '_unread', fg))))
+
         self.refresh()
 
     def refresh(self) -> None:
         """Refresh the model by (re-) running "notmuch search"."""
+
+        self.set_threads(search_json(self.q))
+
+    def set_threads(self, d: List[dict]) -> None:
+        """Replace the contents of the model with the given search results
+
+        :param d: a list of JSON thread summaries, as returned by :func:`search_json`"""
+
         self.beginResetModel()
-        r = subprocess.run(['notmuch', 'search', '--format=json', self.q],
-                stdout=subprocess.PIPE)
-        self.json_str = r.stdout.decode('utf-8')
-        self.d = json.loads(self.json_str)
+        self.d = d
+
+        # precompute the per-row values used by data()
+        self._tagsets = [frozenset(t['tags']) for t in self.d]
+        self._unread = bytearray(1 if 'unread' in tags else 0 for tags in self._tagsets)
+
+        # one list of display strings per column, indexed by column number then row
+        self._display: List[List[Optional[str]]] = []
+        for col in columns:
+            if col == 'tags':
+                self._display.append([tag_string(t['tags']) for t in self.d])
+            elif col in column_keys:
+                key = column_keys[col]
+                self._display.append([t.get(key) for t in self.d])
+            else:
+                self._display.append([None] * len(self.d))
         self.endResetModel()
 
+    def apply_tags(self, row: int, tag_expr: str) -> None:
+        """Apply a tag expression to the thread in the given row of the model only
+
+        This updates the view immediately, without waiting for notmuch. It does not change the
+        notmuch database.
+
+        :param row: the row of the thread
+        :param tag_expr: one or more statements of the form "+TAG" or "-TAG", separated by whitespace
+        """
+
+        if row < 0 or row >= len(self.d): return
+
+        tags = list(self.d[row]['tags'])
+        for t in tag_expr.split():
+            if t[0] == '+' and t[1:] not in tags: tags.append(t[1:])
+            elif t[0] == '-' and t[1:] in tags: tags.remove(t[1:])
+        tags.sort()
+
+        self.d[row]['tags'] = tags
+        self._tagsets[row] = frozenset(tags)
+        self._unread[row] = 1 if 'unread' in tags else 0
+        if 'tags' in columns:
+            self._display[columns.index('tags')][row] = tag_string(tags)
+
+        self.dataChanged.emit(self.index(row, 0), self.index(row, len(columns) - 1))
+
     def num_threads(self) -> int:
         """The number of threads returned by the search"""
 
@@ -64,6 +161,15 @@ class SearchModel(QAbstractItemModel):
         else:
             return None
 
+    def thread_tags(self, index: QModelIndex) -> FrozenSet[str]:
+        """Return the set of tags of the thread at the given model index"""
+
+        row = index.row()
+        if row >= 0 and row < len(self._tagsets):
+            return self._tagsets[row]
+        else:
+            return frozenset()
+
     def thread_id(self, index: QModelIndex) -> Optional[str]:
         """Return the notmuch thread id associated with the thread at the given model index"""
 
@@ -76,42 +182,22 @@ class SearchModel(QAbstractItemModel):
     def data(self, index: QModelIndex, role: int=Qt.DisplayRole) -> Any:
         """Overrides `QAbstractItemModel.data` to populate a view with search results"""
 
-        global columns
-        if index.row() >= len(self.d) or index.column() >= len(columns):
+        row = index.row()
+        col = index.column()
+        if row >= len(self.d) or col >= len(self._display):
             return None
 
-        thread_d = self.d[index.row()]
-        col = columns[index.column()]
-
         if role == Qt.DisplayRole:
-            if col == 'date':
-                return thread_d['date_relative']
-            elif col == 'from':
-                return thread_d['authors']
-            elif col == 'subject':
-                return thread_d['subject']
-            elif col == 'tags':
-                return ' '.join([settings.tag_icons[t] if t in settings.tag_icons else f'[{t}]' for t in thread_d['tags']])
+            return self._display[col][row]
         elif role == Qt.FontRole:
-            font = QFont(settings.search_font, settings.search_font_size)
-            if 'unread' in thread_d['tags']:
-                font.setBold(True)
-            return font
+            return self._font_bold if self._unread[row] else self._font_normal
         elif role == Qt.ForegroundRole:
-            color = 'fg_' + col
-            unread_color = 'fg_' + col + '_unread'
-            if 'unread' in thread_d['tags'] and unread_color in settings.theme:
-                return QColor(settings.theme[unread_color])
-            elif color in settings.theme:
-                return QColor(settings.theme[color])
-            else:
-                return QColor(settings.theme['fg'])
+            return self._fg[col][self._unread[row]]
 
     def headerData(self, section: int, orientation: Qt.Orientation, role: int=Qt.DisplayRole) -> Any:
         """Overrides `QAbstractItemModel.headerData` to populate a view with column names"""
 
-        global columns
-        if role == Qt.DisplayRole and section <= len(columns):
+        if role == Qt.DisplayRole and section < len(columns):
             return columns[section]
         else:
             return None
@@ -125,7 +211,6 @@ class SearchModel(QAbstractItemModel):
     def columnCount(self, index: QModelIndex=QModelIndex()) -> int:
         """The number of columns"""
 
-        global columns
         return len(columns)
 
     def rowCount(self, index: QModelIndex=QModelIndex()) -> int:
@@ -163,22 +248,84 @@ class SearchPanel(panel.Panel):
         self.tree.setColumnWidth(1, 150)
         self.tree.setColumnWidth(2, 900)
         self.tree.doubleClicked.connect(self.open_current_thread)
+        self.refresh_thread: Optional[SearchRefreshThread] = None
+        self.refresh_again = False
+
+        # tag commands given while a refresh is running, applied once the listing is up to date
+        self.deferred_commands: List[Callable[[], None]] = []
+        self.running_deferred = False
         if self.tree.model().rowCount() > 0:
             self.tree.setCurrentIndex(self.tree.model().index(0,0))
 
     def refresh(self) -> None:
-        """Refresh the search listing and restore the selection, if possible."""
+        """Refresh the search listing and restore the selection, if possible.
 
-        current = self.tree.currentIndex()
-        self.model.refresh()
-        
-        if current.row() >= self.model.num_threads():
-            self.last_thread()
-        else:
-            self.tree.setCurrentIndex(current)
+        The search runs asynchronously using :class:`~dodo.search.SearchRefreshThread`, so the
+        listing is updated once "notmuch search" returns. If a refresh is already running, another
+        one is started as soon as it is done. Tag commands given in the meantime are held back
+        until the listing is up to date, so they act on the same threads they would have if
+        the search was instant."""
 
         super().refresh()
 
+        if self.refresh_thread:
+            self.refresh_again = True
+            return
+
+        self.refresh_thread = SearchRefreshThread(self.q, parent=self)
+
+        def done() -> None:
+            if self.refresh_thread:
+                row = self.tree.currentIndex().row()
+                self.model.set_threads(self.refresh_thread.result)
+                self.refresh_thread.deleteLater()
+                self.refresh_thread = None
+
+                if row >= self.model.num_threads():
+                    row = self.model.num_threads() - 1
+                ix = self.model.index(row, 0)
+                if self.model.checkIndex(ix):
+                    self.tree.setCurrentIndex(ix)
+
+            if self.refresh_again:
+                self.refresh_again = False
+                self.refresh()
+            else:
+                self.run_deferred_commands()
+
+        self.refresh_thread.finished.connect(done)
+        self.refresh_thread.start()
+
+    def defer_command(self, command: Callable[[], None], tags: bool=False) -> bool:
+        """Hold back a command until the listing is up to date, if necessary
+
+        Commands that change tags are held back while a refresh is running. Any other command
+        given after one of those is held back too, so commands always run in the order given.
+
+        :param command: the command to run later
+        :param tags: True if the command changes tags
+        :returns: True if the command was held back, in which case the caller should do nothing
+        """
+
+        if self.running_deferred: return False
+        if self.deferred_commands or (tags and self.refresh_thread):
+            self.deferred_commands.append(command)
+            return True
+        return False
+
+    def run_deferred_commands(self) -> None:
+        """Run commands held back by :func:`defer_command`, in the order they were given
+
+        This stops if a command starts another refresh, e.g. by changing tags, and carries on once
+        that refresh is done."""
+
+        self.running_deferred = True
+        try:
+            while self.deferred_commands and not self.refresh_thread:
+                self.deferred_commands.pop(0)()
+        finally:
+            self.running_deferred = False
+
     def title(self) -> str:
         """Give the query as the tab title"""
 
@@ -187,6 +334,8 @@ class SearchPanel(panel.Panel):
     def next_thread(self) -> None:
         """Select the next thread in the search"""
 
+        if self.defer_command(self.next_thread): return
+
         row = self.tree.currentIndex().row() + 1
         if row >= 0 and row < self.tree.model().rowCount():
             self.tree.setCurrentIndex(self.tree.model().index(row, 0))
@@ -194,6 +343,8 @@ class SearchPanel(panel.Panel):
     def previous_thread(self) -> None:
         """Select the previous thread in the search"""
 
+        if self.defer_command(self.previous_thread): return
+
         row = self.tree.currentIndex().row() - 1
         if row >= 0 and row < self.tree.model().rowCount():
             self.tree.setCurrentIndex(self.tree.model().index(row, 0))
@@ -201,6 +352,8 @@ class SearchPanel(panel.Panel):
     def first_thread(self) -> None:
         """Select the first thread in the search"""
 
+        if self.defer_command(self.first_thread): return
+
         ix = self.model.index(0, 0)
         if self.model.checkIndex(ix):
             self.tree.setCurrentIndex(ix)
@@ -208,6 +361,8 @@ class SearchPanel(panel.Panel):
     def last_thread(self) -> None:
         """Select the last thread in the search"""
 
+        if self.defer_command(self.last_thread): return
+
         ix = self.model.index(self.tree.model().rowCount()-1, 0)
         if self.model.checkIndex(ix):
             self.tree.setCurrentIndex(ix)
@@ -215,6 +370,8 @@ class SearchPanel(panel.Panel):
     def open_current_thread(self) -> None:
         """Open the selected thread"""
 
+        if self.defer_command(self.open_current_thread): return
+
         thread_id = self.model.thread_id(self.tree.currentIndex())
         if thread_id:
             self.app.open_thread(thread_id)
@@ -222,9 +379,11 @@ class SearchPanel(panel.Panel):
     def toggle_thread_tag(self, tag: str) -> None:
         """Toggle the given thread tag"""
 
-        thread = self.model.thread_json(self.tree.currentIndex())
-        if thread:
-            if tag in thread['tags']:
+        if self.defer_command(lambda: self.toggle_thread_tag(tag), tags=True): return
+
+        ix = self.tree.currentIndex()
+        if self.model.thread_json(ix):
+            if tag in self.model.thread_tags(ix):
                 tag_expr = '-' + tag
             else:
                 tag_expr = '+' + tag
@@ -237,12 +396,18 @@ class SearchPanel(panel.Panel):
         A tag expression is a string consisting of one more statements of the form "+TAG"
         or "-TAG" to add or remove TAG, respectively, separated by whitespace."""
 
-        thread_id = self.model.thread_id(self.tree.currentIndex())
+        if self.defer_command(lambda: self.tag_thread(tag_expr), tags=True): return
+
+        ix = self.tree.currentIndex()
+        thread_id = self.model.thread_id(ix)
         if not ('+' in tag_expr or '-' in tag_expr):
             tag_expr = '+' + tag_expr
         
         if thread_id:
             subprocess.run(['notmuch', 'tag'] + tag_expr.split() + ['--', 'thread:' + thread_id])
+
+            # show the new tags right away, rather than once the refresh below is done
+            self.model.apply_tags(ix.row(), tag_expr)
             self.app.invalidate_panels()
             self.refresh()
 
@@ -78,6 +78,13 @@ written to STDIN. Note that it should read the destination from the `From:` head
 of the message and not a command-line argument.
 """
 
+max_attachment_size = 25 * 1024 * 1024
+"""Largest file, in bytes, that can be attached to an outgoing message
+
+If an attachment is bigger than this, the message is not sent. Set this to -1 to
+disable the check.
+"""
+
 sync_mail_command = 'offlineimap'
 """Command used to sync IMAP with local Maildir"""
 
@@ -17,7 +17,7 @@
 # along with Dodo. If not, see <https://www.gnu.org/licenses/>.
 
 from __future__ import annotations
-from typing import List, Optional, Any, Union
+from typing import List, Dict, Tuple, Iterable, Optional, Any, Union
 
 from PyQt5.QtCore import *
 from PyQt5.QtGui import QFont, QColor, QDesktopServices
@@ -28,6 +28,10 @@ from PyQt5.QtWebEngineWidgets import *
 import subprocess
 import json
 import html
+from collections import OrderedDict
+import itertools
+import operator
+import sys
 import email
 import email.message
 import tempfile
@@ -39,18 +43,22 @@ from . import keymap
 from . import panel
 
 
+maildir_flag_tags = {'draft', 'flagged', 'passed', 'replied', 'unread'}
+"""Tags that notmuch synchronizes with maildir flags in the filename"""
+
 def flat_thread(d: dict) -> List[dict]:
     "Return the thread as a flattened list of messages, sorted by date."
 
+    # walk the nested lists with an explicit stack, so deep threads can't hit the recursion limit
     thread: List[dict] = []
-    def dfs(x: Union[list, dict]) -> None:
+    stack: List[Union[list, dict]] = [d]
+    while stack:
+        x = stack.pop()
         if isinstance(x, list):
-            for y in x:
-                dfs(y)
+            stack.extend(reversed(x))
         else: thread.append(x)
 
-    dfs(d)
-    thread.sort(key=lambda m: m['timestamp'])
+    thread.sort(key=operator.itemgetter('timestamp'))
     return thread
 
 def short_string(m: dict) -> str:
@@ -100,37 +108,84 @@ class MessagePage(QWebEnginePage):
 
 
 class MessageHandler(QWebEngineUrlSchemeHandler):
+    """Serves message bodies for URLs of the form "message:MODE/MESSAGE_ID"
+
+    MODE is either 'html' or 'plain'. One handler is shared by all thread panels, so it keeps
+    the message currently shown by each of them."""
+
+    render_cache_size = 8
+    """The number of rendered pages kept in memory"""
+
     def __init__(self, parent: Optional[QObject]=None):
         super().__init__(parent)
-        self.message_json: Optional[dict] = None
+        self.messages: Dict[str, dict] = {}
+        self._render_cache: OrderedDict[Tuple[str, str], Tuple[bytes, ...]] = OrderedDict()
 
-    def requestStarted(self, request: QWebEngineUrlRequestJob) -> None:
-        mode = request.requestUrl().toString()[len('message:'):]
-
-        if self.message_json:
-            buf = QBuffer(parent=self)
-            buf.open(QIODevice.WriteOnly)
-            if mode == 'html':
-                html = util.body_html(self.message_json)
-                if html: buf.write(html.encode('utf-8'))
-            else:
-                text = util.colorize_text(util.simple_escape(util.body_text(self.message_json)))
-                text = util.linkify(text)
+        # the message CSS only depends on the settings, so fill it in once
+        self._css_block = f'<style type="text/css">{util.make_message_css()}</style>'
 
-                if text:
-                    buf.write(f"""
+        # the plain text view only varies in the <pre> block, so keep the rest as ready-made bytes
+        self._text_header = f"""
                     <html>
                     <head>
                     <meta http-equiv="Content-Type" content="text/html; charset=utf-8"/>
-                    <style type="text/css">
-                    {util.make_message_css()}
-                    </style>
+                    {self._css_block}
                     </head>
                     <body>
-                    <pre style="white-space: pre-wrap">{text}</pre>
+                    <pre style="white-space: pre-wrap">""".encode('utf-8')
+        self._text_footer = """</pre>
                     </body>
-                    </html>""".encode('utf-8'))
+                    </html>""".encode('utf-8')
 
+    def set_message(self, thread_id: str, m: Optional[dict]) -> None:
+        """Set the message shown by the panel for the given thread, or None if it was closed"""
+
+        if m is None: self.messages.pop(thread_id, None)
+        else: self.messages[thread_id] = m
+
+    def message(self, msg_id: str) -> Optional[dict]:
+        """Return the JSON message with the given id, if it is shown by any panel"""
+
+        for m in self.messages.values():
+            if m.get('id') == msg_id: return m
+        return None
+
+    def render(self, m: dict, mode: str) -> Tuple[bytes, ...]:
+        """Render the body of a message as HTML
+
+        :param m: a JSON message
+        :param mode: 'html' to show the HTML part of the message, otherwise show the plain text
+        :returns: the page, as a tuple of byte strings to be written out one after another
+        """
+
+        if mode == 'html':
+            html = util.body_html(m)
+            return (html.encode('utf-8'),) if html else ()
+        else:
+            text = util.colorize_text(util.simple_escape(util.body_text(m)))
+            text = util.linkify(text)
+            return (self._text_header, text.encode('utf-8'), self._text_footer) if text else ()
+
+    def requestStarted(self, request: QWebEngineUrlRequestJob) -> None:
+        mode, _, msg_id = request.requestUrl().path().partition('/')
+        m = self.message(msg_id)
+
+        if m:
+            # message bodies never change, so recently rendered pages can be reused, e.g. when
+            # toggling between HTML and plain text
+            key = (msg_id, mode)
+            page = self._render_cache.get(key)
+            if page is None:
+                page = self.render(m, mode)
+                self._render_cache[key] = page
+                if len(self._render_cache) > self.render_cache_size:
+                    self._render_cache.popitem(last=False)
+            else:
+                self._render_cache.move_to_end(key)
+
+            buf = QBuffer(parent=self)
+            buf.open(QIODevice.WriteOnly)
+            for chunk in page: buf.write(chunk)
             buf.close()
             request.reply('text/html'.encode('latin1'), buf)
         else:
@@ -138,34 +193,53 @@ class MessageHandler(QWebEngineUrlSchemeHandler):
 
 
 class EmbeddedImageHandler(QWebEngineUrlSchemeHandler):
+    """Serves the parts of messages referenced by "cid:" URLs
+
+    One handler is shared by all thread panels, so it keeps the parts of the message currently
+    shown by each of them. Content-IDs are globally unique, so they can all be looked up together."""
+
     def __init__(self, parent: Optional[QObject]=None):
         super().__init__(parent)
-        self.message: Optional[email.message.Message] = None
+        self.cid_parts: Dict[str, Dict[str, email.message.Message]] = {}
+
+    def set_message(self, thread_id: str, filename: Optional[str]) -> None:
+        """Parse the message file shown by the panel for the given thread and index its parts by
+        Content-ID, or forget them if `filename` is None
+
+        Content-IDs are stored without the enclosing angle brackets and in lower case, since some
+        mailers don't use the same case in "cid:" links as in the Content-ID header."""
 
-    def set_message(self, filename: str) -> None:
-        with open(filename) as f:
-            self.message = email.message_from_file(f)
+        self.cid_parts.pop(thread_id, None)
+        if filename is None: return
+
+        try:
+            with open(filename, 'rb') as f:
+                message = email.message_from_binary_file(f)
+        except OSError:
+            return
+
+        parts: Dict[str, email.message.Message] = {}
+        for part in message.walk():
+            cid = part.get('Content-id')
+            if cid:
+                parts.setdefault(cid.strip().strip('<>').lower(), part)
+        self.cid_parts[thread_id] = parts
 
     def requestStarted(self, request: QWebEngineUrlRequestJob) -> None:
-        cid = request.requestUrl().toString()[len('cid:'):]
-
-        content_type = None
-        if self.message:
-            for part in self.message.walk():
-                if "Content-id" in part and part["Content-id"] == f'<{cid}>':
-                    content_type = part.get_content_type()
-                    buf = QBuffer(parent=self)
-                    buf.open(QIODevice.WriteOnly)
-                    buf.write(part.get_payload(decode=True))
-                    buf.close()
-                    request.reply(content_type.encode('latin1'), buf)
-                    break
-
-            # with open('/home/aleks/git/dodo/images/dodo-screen-inbox.png', 'rb') as f:
-            #     buf.write(f.read())
-            # buf.close()
-
-        if not content_type:
+        cid = request.requestUrl().path().lower()
+
+        part = None
+        for parts in self.cid_parts.values():
+            part = parts.get(cid)
+            if part is not None: break
+        if part is not None:
+            content_type = part.get_content_type()
+            buf = QBuffer(parent=self)
+            buf.open(QIODevice.WriteOnly)
+            buf.write(part.get_payload(decode=True))
+            buf.close()
+            request.reply(content_type.encode('latin1'), buf)
+        else:
             request.fail(QWebEngineUrlRequestJob.UrlNotFound)
 
 class ThreadModel(QAbstractItemModel):
@@ -179,25 +253,118 @@ class ThreadModel(QAbstractItemModel):
     :param thread_id: the unique thread identifier used by notmuch
     """
 
+    refreshed = pyqtSignal()
+    """Emitted when an asynchronous :func:`refresh` has finished"""
+
     def __init__(self, thread_id: str) -> None:
         super().__init__()
         self.thread_id = thread_id
+        self.process: Optional[QProcess] = None
+
+        # data() is called many times per row on every repaint, so only build these once. Read
+        # messages use the font and palette of the view, so only unread ones need anything here.
+        self._font_bold = QFont(settings.search_font, settings.search_font_size)
+        self._font_bold.setBold(True)
+        self._color_unread = QColor(settings.theme['fg_subject_unread'])
+
+        # start out empty, and load the thread in the background so opening it doesn't block the UI
+        self.set_thread([])
         self.refresh()
 
+    def show_command(self) -> List[str]:
+        """The "notmuch show" command used to populate the model"""
+
+        return ['notmuch', 'show', '--format=json', '--include-html', self.thread_id]
+
     def refresh(self) -> None:
-        """Refresh the model by calling "notmuch show"."""
+        """Refresh the model by calling "notmuch show"
+
+        This runs notmuch asynchronously using a `QProcess` and emits :attr:`refreshed` once the
+        model has been updated. If a refresh is already running, it is cancelled."""
+
+        if self.process:
+            self.process.kill()
+
+        p = QProcess(self)
+        self.process = p
+
+        # collect the output as it arrives, rather than letting QProcess buffer all of it
+        out = bytearray()
+        def read() -> None:
+            out.extend(p.readAllStandardOutput().data())
+
+        def done(exit_code: int, exit_status: QProcess.ExitStatus) -> None:
+            if self.process is p:
+                self.process = None
+                if exit_status == QProcess.NormalExit and exit_code == 0:
+                    read()
+                    self.set_json(out)
+                    self.refreshed.emit()
+            p.deleteLater()
+
+        def error(e: QProcess.ProcessError) -> None:
+            # if notmuch couldn't be started, finished is never emitted
+            if e == QProcess.FailedToStart:
+                done(-1, QProcess.CrashExit)
+
+        p.readyReadStandardOutput.connect(read)
+        p.finished.connect(done)
+        p.errorOccurred.connect(error)
+        cmd = self.show_command()
+        p.start(cmd[0], cmd[1:])
+
+    def set_json(self, data: Union[bytes, bytearray]) -> None:
+        """Replace the contents of the model with the JSON output of "notmuch show"."""
+
+        self.set_thread(json.loads(data))
+
+    def set_thread(self, d: Any) -> None:
+        """Replace the contents of the model with an already-parsed "notmuch show" result"""
 
-        r = subprocess.run(['notmuch', 'show', '--format=json', '--include-html', self.thread_id],
-                stdout=subprocess.PIPE, encoding='utf8')
-        self.json_str = r.stdout
-        self.d = json.loads(self.json_str)
+        self.d = d
         self.beginResetModel()
         self.message_list = flat_thread(self.d)
+
+        # the same few tag names appear on every message, so share one copy of each string, and
+        # store tags as sets for fast membership tests
+        for m in self.message_list:
+            m['tags'] = frozenset(sys.intern(t) for t in m.get('tags', ()))
+            headers = m.get('headers')
+            if headers and 'From' in headers:
+                headers['From'] = sys.intern(headers['From'])
+
+        self._from_strs = [short_string(m) for m in self.message_list]
+        self._is_unread = [('unread' in m['tags']) for m in self.message_list]
         self.endResetModel()
 
+    def apply_tags(self, i: int, tag_expr: str) -> None:
+        """Apply a tag expression to the i-th message in the model only
+
+        This updates the view immediately, without waiting for notmuch. It does not change the
+        notmuch database.
+
+        :param i: the index of the message
+        :param tag_expr: one or more statements of the form "+TAG" or "-TAG", separated by whitespace
+        """
+
+        m = self.message_list[i]
+        tags = set(m.get('tags', ()))
+        for t in tag_expr.split():
+            if t[0] == '+': tags.add(sys.intern(t[1:]))
+            elif t[0] == '-': tags.discard(t[1:])
+        m['tags'] = frozenset(tags)
+        self._is_unread[i] = 'unread' in tags
+
+        ix = self.index(i, 0)
+        self.dataChanged.emit(ix, ix, [Qt.FontRole, Qt.ForegroundRole])
+
     def message_at(self, i: int) -> dict:
-        """A JSON object describing the i-th message in the (flattened) thread"""
+        """A JSON object describing the i-th message in the (flattened) thread
 
+        If there is no such message, e.g. because the thread hasn't been loaded yet, this returns
+        an empty dict."""
+
+        if i < 0 or i >= len(self.message_list): return {}
         return self.message_list[i]
 
     def default_message(self) -> int:
@@ -225,23 +392,14 @@ class ThreadModel(QAbstractItemModel):
         if index.row() >= len(self.message_list):
             return None
 
-        m = self.message_list[index.row()]
+        row = index.row()
 
         if role == Qt.DisplayRole:
-            if 'headers' in m and 'From' in m["headers"]:
-                return m['headers']['From']
-            else:
-                return '(message)'
+            return self._from_strs[row]
         elif role == Qt.FontRole:
-            font = QFont(settings.search_font, settings.search_font_size)
-            if 'tags' in m and 'unread' in m['tags']:
-                font.setBold(True)
-            return font
+            return self._font_bold if self._is_unread[row] else None
         elif role == Qt.ForegroundRole:
-            if 'tags' in m and 'unread' in m['tags']:
-                return QColor(settings.theme['fg_subject_unread'])
-            else:
-                return QColor(settings.theme['fg'])
+            return self._color_unread if self._is_unread[row] else None
 
     def index(self, row: int, column: int, parent: QModelIndex=QModelIndex()) -> QModelIndex:
         """Construct a `QModelIndex` for the given row and (irrelevant) column"""
@@ -279,6 +437,45 @@ class ThreadPanel(panel.Panel):
     :param thread_id: the unique ID notmuch uses to identify this thread
     """
 
+    _ROW_TMPL = '<tr><td><b style="color: {fgb}">{name}:&nbsp;</b></td><td>{val}</td></tr>'
+    """Template for a row of the header table built by :func:`header_html`"""
+
+    message_profile: Optional[QWebEngineProfile] = None
+    """The web profile shared by the message views of all thread panels"""
+
+    message_handler: MessageHandler
+    """Handler for "message:" URLs, shared by all thread panels"""
+
+    image_handler: EmbeddedImageHandler
+    """Handler for "cid:" URLs, shared by all thread panels"""
+
+    @classmethod
+    def shared_profile(cls, a: app.Dodo) -> QWebEngineProfile:
+        """Return the web profile used to show messages, creating it the first time it is needed
+
+        The scheme handlers installed on the profile keep the message shown by each panel, which
+        :func:`show_message` passes to them."""
+
+        if cls.message_profile:
+            return cls.message_profile
+
+        # this lives as long as the app, so Qt doesn't clean up the profile while pages still use it
+        profile = QWebEngineProfile(a)
+
+        cls.image_handler = EmbeddedImageHandler(a)
+        profile.installUrlSchemeHandler(b'cid', cls.image_handler)
+
+        cls.message_handler = MessageHandler(a)
+        profile.installUrlSchemeHandler(b'message', cls.message_handler)
+
+        # cls.message_request_interceptor = MessageRequestInterceptor(profile)
+        # profile.setUrlRequestInterceptor(cls.message_request_interceptor)
+        profile.settings().setAttribute(
+                QWebEngineSettings.JavascriptEnabled, False)
+
+        cls.message_profile = profile
+        return profile
+
     def __init__(self, a: app.Dodo, thread_id: str, parent: Optional[QWidget]=None):
         super().__init__(a, parent=parent)
         window_settings = QSettings("dodo", "dodo")
@@ -289,6 +486,25 @@ class ThreadPanel(panel.Panel):
 
         self.subject = '(no subject)'
         self.current_message = -1
+        self._header_cache: Dict[tuple, str] = {}
+        self._shown_header: Optional[tuple] = None
+
+        # tag changes are collected for a short time, then applied by _flush_tags
+        self._pending_tags: List[Tuple[str, str]] = []
+        self._sent_tags: List[Tuple[str, str]] = []
+        self._tag_process: Optional[QProcess] = None
+        self._refresh_after_tags = False
+        self._tag_timer = QTimer(self)
+        self._tag_timer.setSingleShot(True)
+        self._tag_timer.setInterval(50)
+        self._tag_timer.timeout.connect(self._flush_tags)
+
+        # updates to the selection and headers are posted to the event loop with this timer, so
+        # that several requests are handled at once and don't hold up loading the message body
+        self._info_timer = QTimer(self)
+        self._info_timer.setSingleShot(True)
+        self._info_timer.setInterval(0)
+        self._info_timer.timeout.connect(self.update_message_info)
 
         self.splitter = QSplitter(Qt.Vertical)
         info_area = QWidget()
@@ -296,6 +512,7 @@ class ThreadPanel(panel.Panel):
 
         self.thread_list = QListView()
         self.thread_list.setFocusPolicy(Qt.NoFocus)
+        self.thread_list.setFont(QFont(settings.search_font, settings.search_font_size))
         self.thread_list.setModel(self.model)
         self.thread_list.setFixedWidth(250)
         self.thread_list.clicked.connect(lambda ix: self.show_message(ix.row()))
@@ -305,39 +522,62 @@ class ThreadPanel(panel.Panel):
         info_area.layout().addWidget(self.message_info)
         self.splitter.addWidget(info_area)
 
-        # TODO: this leaks memory, but stops Qt from cleaning up the profile too soon
-        self.message_profile = QWebEngineProfile(self.app)
+        # the web view is expensive to set up, so it is only created by _ensure_web_view once the
+        # first message is actually shown. Until then, a placeholder holds its place in the splitter.
+        self.message_view: Optional[QWebEngineView] = None
+        self._view_placeholder = QWidget()
+        self.splitter.addWidget(self._view_placeholder)
+
+        self.layout().addWidget(self.splitter)
+        self._splitter_state = window_settings.value("thread_splitter_state")
+        self.splitter.splitterMoved.connect(
+                lambda x: window_settings.setValue("thread_splitter_state", self.splitter.saveState()))
+        if self._splitter_state: self.splitter.restoreState(self._splitter_state)
+
+        self.model.refreshed.connect(self._reapply_tags)
+        self.model.refreshed.connect(self._header_cache.clear)
+        self.model.refreshed.connect(self.update_message_info)
 
-        self.image_handler = EmbeddedImageHandler(self)
-        self.message_profile.installUrlSchemeHandler(b'cid', self.image_handler)
+        # the model loads the thread in the background, so the first message is shown once it is done
+        self.model.refreshed.connect(self._show_first_message)
 
-        self.message_handler = MessageHandler(self)
-        self.message_profile.installUrlSchemeHandler(b'message', self.message_handler)
+    def _show_first_message(self) -> None:
+        """Show the default message once the thread has been loaded for the first time"""
 
-        # self.message_request_interceptor = MessageRequestInterceptor(self.message_profile)
-        # self.message_profile.setUrlRequestInterceptor(self.message_request_interceptor)
-        self.message_profile.settings().setAttribute(
-                QWebEngineSettings.JavascriptEnabled, False)
+        if self.current_message != -1: return
+
+        self.current_message = self.model.default_message()
+        if self.current_message >= 0:
+            self.update_message_info()
+            self.show_message()
 
-        self.message_view = QWebEngineView(self)
+            # the tab was added before the subject was known
+            ix = self.app.tabs.indexOf(self)
+            if ix != -1: self.app.tabs.setTabText(ix, self.title())
+
+    def _ensure_web_view(self) -> QWebEngineView:
+        """Create the web view used to show message bodies, if it doesn't exist yet"""
+
+        if self.message_view:
+            return self.message_view
+
+        profile = ThreadPanel.shared_profile(self.app)
+        view = QWebEngineView(self)
 
         # QWebEngineProfile.defaultProfile().setRequestInterceptor(self.message_request_interceptor)
-        # self.message_view.settings().setAttribute(
+        # view.settings().setAttribute(
         #         QWebEngineSettings.WebAttribute.JavascriptEnabled, False)
 
-        page = MessagePage(self.app, self.message_profile, self.message_view)
-        self.message_view.setPage(page)
-
-        self.message_view.setZoomFactor(1.2)
-        self.splitter.addWidget(self.message_view)
+        page = MessagePage(self.app, profile, view)
+        view.setPage(page)
+        view.setZoomFactor(1.2)
 
-        self.layout().addWidget(self.splitter)
-        state = window_settings.value("thread_splitter_state")
-        self.splitter.splitterMoved.connect(
-                lambda x: window_settings.setValue("thread_splitter_state", self.splitter.saveState()))
-        if state: self.splitter.restoreState(state)
+        self.splitter.replaceWidget(self.splitter.indexOf(self._view_placeholder), view)
+        self._view_placeholder.deleteLater()
+        if self._splitter_state: self.splitter.restoreState(self._splitter_state)
 
-        self.show_message(self.model.default_message())
+        self.message_view = view
+        return view
 
 
     def title(self) -> str:
@@ -350,11 +590,47 @@ class ThreadPanel(panel.Panel):
     def refresh(self) -> None:
         """Refresh the panel using the output of "notmuch show"
 
+        The model is refreshed asynchronously, and the message list and headers are updated
+        again via :func:`update_message_info` once it is done.
+
         Note the view of the message body is not refreshed, as this would pop the user back to
         the top of the message every time it happens. To refresh the current message body, use
-        :func:`show_message` wihtout any arguments."""
+        :func:`show_message` wihtout any arguments.
+
+        If there are tag changes that haven't reached notmuch yet, they are sent right away and
+        the refresh happens once notmuch is done, so it doesn't read the old tags."""
+
+        if self._pending_tags or self._tag_process:
+            self._refresh_after_tags = True
+            if not self._tag_process:
+                self._tag_timer.stop()
+                self._flush_tags()
+            return
 
         self.model.refresh()
+        self._info_timer.start()
+        super().refresh()
+
+    def _reapply_tags(self) -> None:
+        """Apply tag changes that notmuch may not have seen yet to a freshly loaded model
+
+        A refresh that was already running when the tags were changed can return the old tags, so
+        the changes made locally by :func:`tag_message` are applied again. Tag expressions only
+        add or remove tags, so applying them twice does no harm."""
+
+        ops = self._sent_tags + self._pending_tags
+        if len(ops) == 0: return
+
+        rows = {m.get('id'): i for i, m in enumerate(self.model.message_list)}
+        for tag_expr, query in ops:
+            i = rows.get(query[len('id:'):])
+            if i is not None: self.model.apply_tags(i, tag_expr)
+
+    def update_message_info(self) -> None:
+        """Update the selected message, subject, and header view from the current model"""
+
+        if self.current_message < 0 or self.current_message >= self.model.num_messages(): return
+
         ix = self.thread_list.model().index(self.current_message, 0)
         if self.thread_list.model().checkIndex(ix):
             self.thread_list.setCurrentIndex(ix)
@@ -367,60 +643,88 @@ class ThreadPanel(panel.Panel):
             self.subject = '(no subject)'
 
         if 'headers' in m:
-            header_html = ''
-            header_html += f'<table style="background-color: {settings.theme["bg"]}; color: {settings.theme["fg"]}; font-family: {settings.search_font}; font-size: {settings.search_font_size}pt; width:100%">'
-            for name in ['Subject', 'Date', 'From', 'To', 'Cc']:
-                if name in m['headers']:
-                    header_html += f"""<tr>
-                      <td><b style="color: {settings.theme["fg_bright"]}">{name}:&nbsp;</b></td>
-                      <td>{util.simple_escape(m["headers"][name])}</td>
-                    </tr>"""
-            if 'tags' in m:
-                tags = ' '.join([settings.tag_icons[t] if t in settings.tag_icons else f'[{t}]' for t in m['tags']])
-                header_html += f"""<tr>
-                  <td><b style="color: {settings.theme["fg_bright"]}">Tags:&nbsp;</b></td>
-                  <td><span style="color: {settings.theme["fg_tags"]}">{tags}</span></td>
-                </tr>"""
-
-            attachments = [f'[{part["filename"]}]' for part in util.message_parts(m)
-                    if part.get('content-disposition') == 'attachment' and 'filename' in part]
-
-            if len(attachments) != 0:
-                header_html += f"""<tr>
-                  <td><b style="color: {settings.theme["fg_bright"]}">Attachments:&nbsp;</b></td>
-                  <td><span style="color: {settings.theme["fg_tags"]}">{' '.join(attachments)}</span></td>
-                </tr>"""
-
-            header_html += '</table>'
-            self.message_info.setHtml(header_html)
+            # only rebuild the header table if the message or its tags have changed
+            key = (m.get('id'), m.get('tags', frozenset()))
+            if key != self._shown_header:
+                header_html = self._header_cache.get(key)
+                if header_html is None:
+                    header_html = self.header_html(m)
+                    self._header_cache[key] = header_html
+                self.message_info.setHtml(header_html)
+                self._shown_header = key
+
+    def header_html(self, m: dict) -> str:
+        """Build the HTML table of headers, tags, and attachments shown above a message
+
+        :param m: a JSON message
+        """
 
-        super().refresh()
+        th = settings.theme
+        fgb, fgt = th['fg_bright'], th['fg_tags']
+        row = self._ROW_TMPL.format
+
+        rows = [f'<table style="background-color: {th["bg"]}; color: {th["fg"]}; font-family: {settings.search_font}; font-size: {settings.search_font_size}pt; width:100%">']
+        headers = m['headers']
+        for name in ('Subject', 'Date', 'From', 'To', 'Cc'):
+            if name in headers:
+                rows.append(row(fgb=fgb, name=name, val=util.simple_escape(headers[name])))
+        if 'tags' in m:
+            tags = self._render_tags(m['tags'])
+            rows.append(row(fgb=fgb, name='Tags', val=f'<span style="color: {fgt}">{tags}</span>'))
+
+        parts = (part for part in util.message_parts(m)
+                if part.get('content-disposition') == 'attachment' and 'filename' in part)
+        first = next(parts, None)
+
+        if first is not None:
+            attachments = ' '.join(f'[{part["filename"]}]' for part in itertools.chain((first,), parts))
+            rows.append(row(fgb=fgb, name='Attachments',
+                val=f'<span style="color: {fgt}">{attachments}</span>'))
+
+        rows.append('</table>')
+        return ''.join(rows)
+
+    def _render_tags(self, tags: Iterable[str]) -> str:
+        """Render tags as a string in sorted order, using the icons in `settings.tag_icons` where
+        possible"""
 
-    def show_message(self, i: int=-1) -> None:
+        get = settings.tag_icons.get
+        return ' '.join(get(t, f'[{t}]') for t in sorted(tags))
+
+    def show_message(self, i: int=-1, force: bool=False) -> None:
         """Show a message
 
         If an index is provided, switch the current message to that index, otherwise refresh
-        the view of the current message.
+        the view of the current message. If the index is that of the message already being shown,
+        nothing is reloaded unless `force` is True.
         """
-        if i != -1: self.current_message = i
+        if i != -1:
+            if i < 0 or i >= self.model.num_messages(): return
+            if i == self.current_message and self.message_view and not force: return
+            self.current_message = i
 
         if self.current_message >= 0 and self.current_message < self.model.num_messages():
-            self.refresh()
             m = self.model.message_at(self.current_message)
-            if 'unread' in m['tags']:
-                # this might change the filename, so we should refresh the model
-                self.tag_message('-unread')
-                self.refresh()
-                m = self.model.message_at(self.current_message)
+            view = self._ensure_web_view()
 
-            self.message_handler.message_json = m
-            if 'filename' in m and len(m['filename']) != 0:
-                self.image_handler.set_message(m['filename'][0])
+            # start loading the body first. The page is only requested from the handlers once
+            # control returns to the event loop, so they can still be set up below.
+            self.message_handler.set_message(self.thread_id, m)
+            url = QUrl()
+            url.setScheme('message')
+            url.setPath(('html/' if self.html_mode else 'plain/') + m['id'])
+            view.page().setUrl(url)
 
-            if self.html_mode:
-                self.message_view.page().setUrl(QUrl('message:html'))
+            if 'filename' in m and len(m['filename']) != 0:
+                self.image_handler.set_message(self.thread_id, m['filename'][0])
             else:
-                self.message_view.page().setUrl(QUrl('message:plain'))
+                self.image_handler.set_message(self.thread_id, None)
+
+            # this might change the filename, so only do it after the message file has been read
+            if 'unread' in m['tags']:
+                self.tag_message('-unread')
+
+            self._info_timer.start()
 
 
     def next_message(self) -> None:
@@ -446,6 +750,8 @@ class ThreadPanel(panel.Panel):
         :param pages: scroll up/down the given number of pages. Negative numbers scroll up.
         :param pos: scroll to the given position (possible values are 'top' and 'bottom')
         """
+        if not self.message_view: return
+
         if pos == 'top':
             self.message_view.page().runJavaScript(f'window.scrollTo(0, 0)',
                     QWebEngineScript.ApplicationWorld)
@@ -480,16 +786,82 @@ class ThreadPanel(panel.Panel):
         if m:
             if not ('+' in tag_expr or '-' in tag_expr):
                 tag_expr = '+' + tag_expr
-            r = subprocess.run(['notmuch', 'tag'] + tag_expr.split() + ['--', 'id:' + m['id']],
-                    stdout=subprocess.PIPE)
+
+            self.model.apply_tags(self.current_message, tag_expr)
+            self._info_timer.start()
+
+            # wait briefly for more tag changes, then send them all to notmuch at once
+            self._pending_tags.append((tag_expr, 'id:' + m['id']))
+            if not self._tag_timer.isActive():
+                self._tag_timer.start()
+
+    def _flush_tags(self) -> None:
+        """Apply all pending tag changes with a single "notmuch tag --batch" process"""
+
+        # only run one notmuch process at a time, to avoid fighting over the database lock
+        if self._tag_process:
+            self._tag_timer.start()
+            return
+
+        ops = self._pending_tags
+        self._pending_tags = []
+        if len(ops) == 0: return
+
+        # changing tags that notmuch syncs with maildir flags can rename the message file, so
+        # the model needs to be refreshed to pick up the new filename
+        renames = any(t[1:] in maildir_flag_tags for tag_expr, _ in ops for t in tag_expr.split())
+
+        p = QProcess(self)
+        self._tag_process = p
+        self._sent_tags = ops
+        handled = False
+
+        def done(exit_code: int, exit_status: QProcess.ExitStatus) -> None:
+            # only handle the first of errorOccurred and finished
+            nonlocal handled
+            if handled: return
+            handled = True
+            self._tag_process = None
+            self._sent_tags = []
             self.app.invalidate_panels()
-            self.refresh()
+
+            # reload if notmuch failed, since the tags shown may not match the database, or if a
+            # refresh was held back or is still running with the old tags. The reload is started
+            # after notmuch is done, so it sees the new tags.
+            failed = exit_status != QProcess.NormalExit or exit_code != 0
+            if renames or failed or self._refresh_after_tags or self.model.process:
+                self._refresh_after_tags = False
+                self.refresh()
+            else:
+                self.dirty = False
+            p.deleteLater()
+
+        def error(e: QProcess.ProcessError) -> None:
+            # if notmuch couldn't be started, finished is never emitted
+            if e == QProcess.FailedToStart:
+                done(-1, QProcess.CrashExit)
+
+        p.finished.connect(done)
+        p.errorOccurred.connect(error)
+        p.start('notmuch', ['tag', '--batch'])
+        p.write(''.join(util.tag_batch_line(tag_expr, query) for tag_expr, query in ops).encode('utf-8'))
+        p.closeWriteChannel()
+
+    def before_close(self) -> bool:
+        """Remove this panel's message from the shared scheme handlers before closing"""
+
+        if not super().before_close(): return False
+
+        if self.message_view:
+            self.message_handler.set_message(self.thread_id, None)
+            self.image_handler.set_message(self.thread_id, None)
+        return True
 
     def toggle_html(self) -> None:
         """Toggle between HTML and plain text message view"""
 
         self.html_mode = not self.html_mode
-        self.show_message()
+        self.show_message(force=True)
 
     def reply(self, to_all: bool=True) -> None:
         """Open a :class:`~dodo.compose.ComposePanel` populated with a reply
@@ -500,14 +872,17 @@ class ThreadPanel(panel.Panel):
         :param to_all: if True, do a reply to all instead (see `~dodo.compose.ComposePanel`)
         """
 
-        self.app.compose(mode='replyall' if to_all else 'reply',
-                         msg=self.model.message_at(self.current_message))
+        m = self.model.message_at(self.current_message)
+        if m:
+            self.app.compose(mode='replyall' if to_all else 'reply', msg=m)
 
     def forward(self) -> None:
         """Open a :class:`~dodo.compose.ComposePanel` populated with a forwarded message
         """
 
-        self.app.compose(mode='forward', msg=self.model.message_at(self.current_message))
+        m = self.model.message_at(self.current_message)
+        if m:
+            self.app.compose(mode='forward', msg=m)
 
     def open_attachments(self) -> None:
         """Write attachments out into temp directory and open with `settings.file_browser_command`
@@ -517,6 +892,7 @@ class ThreadPanel(panel.Panel):
         """
 
         m = self.model.message_at(self.current_message)
+        if not m: return
         temp_dir, _ = util.write_attachments(m)
         
         if temp_dir:
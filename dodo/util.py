@@ -27,6 +27,7 @@ import tempfile
 import subprocess
 import email
 import email.header
+import urllib.parse
 from bleach.sanitizer import Cleaner
 from bleach.linkifier import Linker
 
@@ -284,6 +285,32 @@ def add_header_line(s: str, h: str) -> str:
         out += line + '\n'
     return out
 
+def tag_batch_line(tag_expr: str, query: str) -> str:
+    """Format a line of input for "notmuch tag --batch"
+
+    Tags and the query are hex-encoded, as expected by notmuch's batch format.
+
+    :param tag_expr: one or more statements of the form "+TAG" or "-TAG", separated by whitespace
+    :param query: a notmuch query, e.g. "id:MESSAGE_ID"
+    """
+
+    safe = '@=.,_+-:'
+    tags = ' '.join(t[0] + urllib.parse.quote(t[1:], safe=safe) for t in tag_expr.split())
+    return f'{tags} -- {urllib.parse.quote(query, safe=safe)}\n'
+
+def notmuch_tag_batch(ops: List[Tuple[str, str]]) -> None:
+    """Apply several tag expressions with a single call to "notmuch tag --batch"
+
+    This only starts notmuch and opens the database once, rather than once per operation.
+
+    :param ops: a list of pairs (tag_expr, query), passed to :func:`tag_batch_line`
+    """
+
+    if len(ops) == 0: return
+    subprocess.run(['notmuch', 'tag', '--batch'],
+            input=''.join(tag_batch_line(tag_expr, query) for tag_expr, query in ops),
+            stdout=subprocess.PIPE, encoding='utf8')
+
 def make_message_css() -> str:
     """Fill placeholders in settings.message_css using the current theme
     and font settings."""